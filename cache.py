@@ -0,0 +1,78 @@
+"""
+Response caching module for Tesla Competitive Intelligence ETL Pipeline.
+Persists API payloads on disk with per-endpoint time-to-live values.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from typing import Any, Dict, Optional
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# Cache lifetimes (seconds) aligned with how often each dataset changes upstream
+DEFAULT_TTLS = {
+    'income-statement': 90 * 86400,  # reported quarterly
+    'analyst-estimates': 7 * 86400,  # revised weekly
+}
+
+
+class FileCache:
+    """JSON file cache keyed by endpoint and request parameters (API key excluded)."""
+
+    def __init__(self, cache_dir: str = 'data/cache/fmp', ttl_map: Dict[str, int] = None, default_ttl: int = 86400):
+        self.cache_dir = cache_dir
+        self.ttl_map = DEFAULT_TTLS if ttl_map is None else ttl_map
+        self.default_ttl = default_ttl
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def ttl_for(self, endpoint: str) -> int:
+        """Return the TTL for an endpoint based on its root path segment."""
+        return self.ttl_map.get(endpoint.split('/', 1)[0], self.default_ttl)
+
+    def _path(self, endpoint: str, params: Dict[str, Any]) -> str:
+        """Build the cache file path for a request."""
+        key_params = sorted((k, str(v)) for k, v in params.items() if k != 'apikey')
+        digest = hashlib.md5(orjson.dumps([endpoint, key_params])).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.json")
+
+    def _read(self, endpoint: str, params: Dict[str, Any]) -> Optional[Dict]:
+        """Read a raw cache entry, treating unreadable files as misses."""
+        path = self._path(endpoint, params)
+        try:
+            with open(path, 'rb') as f:
+                return orjson.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, orjson.JSONDecodeError) as e:
+            logger.warning(f"Ignoring unreadable cache entry {path}: {e}")
+            return None
+
+    def get(self, endpoint: str, params: Dict[str, Any]) -> Optional[Any]:
+        """Return the cached payload if it is still within its TTL."""
+        entry = self._read(endpoint, params)
+        if entry is None or time.time() - entry['ts'] > entry['ttl']:
+            return None
+        return entry['payload']
+
+    def get_stale(self, endpoint: str, params: Dict[str, Any]) -> Optional[Any]:
+        """Return the cached payload regardless of age, for use when the API is unavailable."""
+        entry = self._read(endpoint, params)
+        return None if entry is None else entry['payload']
+    
+    def set(self, endpoint: str, params: Dict[str, Any], payload: Any, ttl: int = None):
+        """Store a payload, replacing the file atomically so readers never see partial writes."""
+        entry = {'ts': time.time(), 'ttl': ttl or self.ttl_for(endpoint), 'payload': payload}
+        path = self._path(endpoint, params)
+        # A unique temp file per write, so concurrent writers of the same key cannot clobber each other
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(orjson.dumps(entry))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
@@ -1,9 +1,12 @@
 """Configuration module for Tesla ETL Pipeline."""
+import atexit
 import logging
+import queue
 from datetime import date
+from functools import lru_cache
 from decimal import Decimal
 from typing import Optional
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field, field_validator
@@ -21,6 +24,27 @@ load_dotenv()
 # Database base
 Base = declarative_base()
 
+# Threshold below which raw financial values are treated as millions
+ONE_MILLION = Decimal('1000000')
+
+# Tracked companies; COMPANY_TICKERS is the default ticker set everywhere
+COMPANY_NAMES = {
+    'TSLA': 'Tesla Inc',
+    'RIVN': 'Rivian Automotive Inc',
+    'LCID': 'Lucid Group Inc',
+}
+COMPANY_TICKERS = tuple(COMPANY_NAMES)
+
+# Extraction statuses whose data is usable downstream ('stale' = expired cache served after an API failure)
+USABLE_STATUSES = frozenset({'success', 'partial', 'stale'})
+
+
+def check_quarter_label(v: str) -> str:
+    """Validate the "YYYY-QN" shape with plain string checks instead of a regex."""
+    if len(v) != 7 or v[4:6] != '-Q' or v[6] not in '1234' or not (v[:4].isascii() and v[:4].isdigit()):
+        raise ValueError(f"quarter_label must look like 'YYYY-QN', got {v!r}")
+    return v
+
 
 class Settings(BaseSettings):
     """Application settings with environment variable validation."""
@@ -28,11 +52,18 @@ class Settings(BaseSettings):
     database_url: str = Field(default="postgresql://localhost:5432/competitor_intelligence")
     api_rate_limit: int = Field(default=250)
     log_level: str = Field(default="INFO")
+    load_batch_size: int = Field(default=10_000, gt=0, description="Rows per load transaction")
 
     class Config:
         env_file = ".env"
 
 
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Load and validate settings on first use rather than at import."""
+    return Settings()
+
+
 # SQLAlchemy ORM Models
 class Company(Base):
     """Company model for storing EV company information."""
@@ -81,19 +112,22 @@ class FinancialData(BaseModel):
     
     ticker: str = Field(..., min_length=1, max_length=10)
     quarter_date: date
-    quarter_label: str = Field(..., pattern=r'^\d{4}-Q[1-4]$')
+    quarter_label: str
     revenue: Optional[Decimal] = Field(None, max_digits=15, decimal_places=2)
     eps: Optional[Decimal] = Field(None, max_digits=10, decimal_places=4)
     gross_profit: Optional[Decimal] = Field(None, max_digits=15, decimal_places=2)
     
+    _check_quarter_label = field_validator('quarter_label')(check_quarter_label)
+    
     @field_validator('revenue', 'gross_profit', mode='before')
     @classmethod
     def convert_millions_to_dollars(cls, v):
         """Convert from millions to actual dollar amounts if needed."""
         if v is not None and isinstance(v, (int, float, Decimal)):
+            value = v if isinstance(v, Decimal) else Decimal(str(v))
             # If value is less than 1M, assume it's in millions
-            if Decimal(str(v)) < Decimal('1000000'):
-                return Decimal(str(v)) * Decimal('1000000')
+            if value < ONE_MILLION:
+                return value * ONE_MILLION
         return v
 
 
@@ -102,23 +136,28 @@ class EstimateData(BaseModel):
     
     ticker: str = Field(..., min_length=1, max_length=10)
     quarter_date: date
-    quarter_label: str = Field(..., pattern=r'^\d{4}-Q[1-4]$')
+    quarter_label: str
     estimated_revenue: Optional[Decimal] = Field(None, max_digits=15, decimal_places=2)
     estimated_eps: Optional[Decimal] = Field(None, max_digits=10, decimal_places=4)
     analyst_count: Optional[int] = Field(None, ge=0)
+    
+    _check_quarter_label = field_validator('quarter_label')(check_quarter_label)
 
 
 # Database Configuration
+@lru_cache(maxsize=1)
 def get_database_engine():
-    """Create SQLAlchemy engine with connection pooling."""
-    settings = Settings()
+    """Create the process-wide SQLAlchemy engine with connection pooling."""
+    settings = get_settings()
     
     engine = create_engine(
         settings.database_url,
-        pool_size=20,
-        pool_recycle=3600,
+        pool_size=5,
+        max_overflow=5,
+        pool_timeout=30,
+        pool_recycle=1800,
         pool_use_lifo=True,
-        pool_pre_ping=True,
+        pool_pre_ping=False,  # pool_recycle retires stale connections instead
         echo=False
     )
     return engine
@@ -131,9 +170,14 @@ def get_session_factory():
 
 
 def setup_logging():
-    """Configure logging with file and console handlers."""
+    """Configure logging with file and console handlers; a no-op once the root logger has handlers."""
     logger = logging.getLogger()
-    log_level = 'INFO' if not settings else settings.log_level
+    if logger.handlers:
+        return
+    try:
+        log_level = get_settings().log_level
+    except Exception:  # missing env vars, e.g. under test
+        log_level = 'INFO'
     logger.setLevel(getattr(logging, log_level))
     
     # File and console handlers
@@ -142,10 +186,9 @@ def setup_logging():
     fh.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
     ch.setFormatter(logging.Formatter('%(levelname)s - %(message)s'))
     
-    logger.addHandler(fh)
-    logger.addHandler(ch)
-
-
-# Global settings instance - handle missing env vars for testing
-try: settings = Settings()
-except Exception: settings = None
\ No newline at end of file
+    # Handlers run on a listener thread so file/console I/O never blocks the pipeline
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, fh, ch, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # drain queued records before exit
+    logger.addHandler(QueueHandler(log_queue))
@@ -2,42 +2,101 @@
 Data loading module for Tesla Competitive Intelligence ETL Pipeline.
 Handles bulk loading of financial data into PostgreSQL with proper transaction management.
 """
+import csv
+import io
 import logging
 from contextlib import contextmanager
 from typing import Dict, List, Any, Optional
-from decimal import Decimal
 
 import pandas as pd
-from sqlalchemy import insert, select
-from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import SQLAlchemyError
 
 from config import (
     setup_logging, get_session_factory, Company, QuarterlyFinancial, 
-    AnalystEstimate, FinancialData, EstimateData
+    AnalystEstimate, FinancialData, EstimateData, COMPANY_NAMES, COMPANY_TICKERS
 )
 
-# Setup logging
-setup_logging()
 logger = logging.getLogger(__name__)
 
+DATAFRAME_COLUMNS = ['ticker', 'quarter_date', 'quarter_label', 'revenue', 'eps', 'gross_profit']
+
+# Upsert batching: rows per INSERT statement, and the size above which COPY is used instead
+UPSERT_BATCH_SIZE = 1000
+COPY_THRESHOLD = 5000
+
 
 class LoadError(Exception):
     """Raised when data loading operations fail."""
     pass
 
 
+def _latest_per_quarter(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Keep the last record per (company_id, quarter_date); ON CONFLICT cannot touch a row twice."""
+    return list({(r['company_id'], r['quarter_date']): r for r in records}.values())
+
+
+def _upsert(model, update_columns: List[str], records: List[Dict[str, Any]]):
+    """Build a single INSERT ... ON CONFLICT (company_id, quarter_date) DO UPDATE statement."""
+    stmt = pg_insert(model).values(records)
+    return stmt.on_conflict_do_update(
+        index_elements=['company_id', 'quarter_date'],
+        set_={column: stmt.excluded[column] for column in update_columns}
+    )
+
+
+def _copy_upsert(session, model, update_columns: List[str], records: List[Dict[str, Any]]):
+    """COPY records into a temp staging table, then upsert them with one INSERT ... SELECT."""
+    table = model.__tablename__
+    columns = ', '.join(records[0])
+    updates = ', '.join(f"{column} = EXCLUDED.{column}" for column in update_columns)
+    
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(record.values() for record in records)  # None -> empty field -> NULL
+    buffer.seek(0)
+    
+    with session.connection().connection.cursor() as cursor:
+        cursor.execute(f"CREATE TEMP TABLE {table}_staging ON COMMIT DROP AS SELECT {columns} FROM {table} WITH NO DATA")
+        cursor.copy_expert(f"COPY {table}_staging ({columns}) FROM STDIN WITH CSV", buffer)
+        cursor.execute(
+            f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {table}_staging "
+            f"ON CONFLICT (company_id, quarter_date) DO UPDATE SET {updates}"
+        )
+
+
+def _write_upsert(session, model, update_columns: List[str], records: List[Dict[str, Any]]):
+    """Upsert records, using COPY for large loads and bounded INSERT batches otherwise."""
+    if len(records) > COPY_THRESHOLD:
+        _copy_upsert(session, model, update_columns, records)
+        return
+    for start in range(0, len(records), UPSERT_BATCH_SIZE):
+        session.execute(_upsert(model, update_columns, records[start:start + UPSERT_BATCH_SIZE]))
+
+
 class DatabaseLoader:
     """Handles loading financial data into PostgreSQL with transaction management."""
     
+    # Ticker -> company id, shared by every loader in the process (the engine is process-wide too)
+    _company_ids: Dict[str, int] = {}
+    
     def __init__(self):
         self.session_factory = get_session_factory()
-        self.company_cache = {}
+        self.company_cache = DatabaseLoader._company_ids
+    
+    @classmethod
+    def clear_company_cache(cls):
+        """Forget cached company ids, e.g. after the companies table is rebuilt."""
+        cls._company_ids.clear()
         
     @contextmanager
-    def get_session(self):
+    def get_session(self, durable: bool = True):
         """Context manager for database sessions with automatic rollback on error."""
         session = self.session_factory()
         try:
+            if not durable:
+                # Skip the WAL flush wait on commit; loads can be replayed from source if the server crashes
+                session.execute(text("SET LOCAL synchronous_commit = off"))
             yield session
             session.commit()
         except Exception as e:
@@ -48,33 +107,38 @@ class DatabaseLoader:
             session.close()
     
     def load_companies(self, tickers: List[str] = None) -> Dict[str, int]:
-        """Load companies into database with upsert logic."""
+        """Seed companies idempotently and return their ids (a single SELECT once all exist)."""
         if tickers is None:
-            tickers = ['TSLA', 'RIVN', 'LCID']
-        
-        company_names = {
-            'TSLA': 'Tesla Inc',
-            'RIVN': 'Rivian Automotive Inc', 
-            'LCID': 'Lucid Group Inc'
-        }
+            tickers = COMPANY_TICKERS
         
         company_mapping = {}
         
         with self.get_session() as session:
             try:
                 existing_companies = session.execute(select(Company).where(Company.ticker.in_(tickers))).fetchall()
-                existing_tickers = {company.Company.ticker: company.Company.id for company in existing_companies}
+                company_mapping = {company.Company.ticker: company.Company.id for company in existing_companies}
                 
                 new_companies = [{
-                    'ticker': ticker, 'name': company_names.get(ticker, f'{ticker} Inc'), 'sector': 'Electric Vehicles'
-                } for ticker in tickers if ticker not in existing_tickers]
+                    'ticker': ticker, 'name': COMPANY_NAMES.get(ticker, f'{ticker} Inc'), 'sector': 'Electric Vehicles'
+                } for ticker in dict.fromkeys(tickers) if ticker not in company_mapping]
                 
                 if new_companies:
-                    session.execute(insert(Company), new_companies)
-                    logger.info(f"Inserted {len(new_companies)} new companies")
+                    # RETURNING hands back the new ids, so no second SELECT is needed; DO NOTHING
+                    # keeps concurrent seeding of the same ticker from failing the load
+                    inserted = session.execute(
+                        pg_insert(Company).values(new_companies)
+                        .on_conflict_do_nothing(index_elements=['ticker'])
+                        .returning(Company.id, Company.ticker)
+                    ).fetchall()
+                    company_mapping.update({row.ticker: row.id for row in inserted})
+                    logger.info(f"Inserted {len(inserted)} new companies")
+                    
+                    # DO NOTHING returns no row for tickers another writer inserted first; read those back
+                    raced = [company['ticker'] for company in new_companies if company['ticker'] not in company_mapping]
+                    if raced:
+                        rows = session.execute(select(Company.ticker, Company.id).where(Company.ticker.in_(raced))).all()
+                        company_mapping.update({row.ticker: row.id for row in rows})
                 
-                all_companies = session.execute(select(Company).where(Company.ticker.in_(tickers))).fetchall()
-                company_mapping = {company.Company.ticker: company.Company.id for company in all_companies}
                 self.company_cache.update(company_mapping)
                 
                 logger.info(f"Loaded companies: {list(company_mapping.keys())}")
@@ -84,6 +148,14 @@ class DatabaseLoader:
                 logger.error(f"Failed to load companies: {e}")
                 raise LoadError(f"Company loading failed: {e}")
     
+    def get_company_ids(self, tickers: List[str]) -> Dict[str, int]:
+        """Return company ids from the cache, seeding only tickers not seen yet."""
+        company_ids = {ticker: self.company_cache[ticker] for ticker in tickers if ticker in self.company_cache}
+        missing = [ticker for ticker in tickers if ticker not in company_ids]
+        if missing:
+            company_ids.update(self.load_companies(missing))  # load_companies also fills the cache
+        return company_ids
+    
     def load_quarterly_financials(self, financial_data: List[FinancialData]) -> int:
         """Bulk load quarterly financial data using SQLAlchemy 2.0 syntax."""
         if not financial_data:
@@ -91,67 +163,31 @@ class DatabaseLoader:
             return 0
         
         # Ensure companies are loaded first
-        unique_tickers = list(set([data.ticker for data in financial_data]))
-        company_mapping = self.company_cache or self.load_companies(unique_tickers)
+        unique_tickers = list(dict.fromkeys(data.ticker for data in financial_data))
+        company_mapping = self.get_company_ids(unique_tickers)
         
-        with self.get_session() as session:
+        records = []
+        skipped = 0
+        for data in financial_data:
+            company_id = company_mapping.get(data.ticker)
+            if not company_id:
+                logger.warning(f"Company ID not found for {data.ticker}, skipping")
+                skipped += 1
+                continue
+            
+            # Decimals go straight to the DECIMAL columns; zero values are kept
+            records.append({'company_id': company_id, **data.model_dump(exclude={'ticker'})})
+        
+        # Nothing mapped to a company, so don't open a transaction at all
+        if not records:
+            logger.warning("No valid records to load after processing")
+            return 0
+        records = _latest_per_quarter(records)
+        
+        with self.get_session(durable=False) as session:
             try:
-                records = []
-                skipped = 0
-                
-                for data in financial_data:
-                    company_id = company_mapping.get(data.ticker)
-                    if not company_id:
-                        logger.warning(f"Company ID not found for {data.ticker}, skipping")
-                        skipped += 1
-                        continue
-                    
-                    records.append({
-                        'company_id': company_id,
-                        'quarter_date': data.quarter_date,
-                        'quarter_label': data.quarter_label,
-                        'revenue': float(data.revenue) if data.revenue else None,
-                        'eps': float(data.eps) if data.eps else None,
-                        'gross_profit': float(data.gross_profit) if data.gross_profit else None
-                    })
-                
-                if not records:
-                    logger.warning("No valid records to load after processing")
-                    return 0
-                
-                # Use SQLAlchemy 2.0 bulk insert with ON CONFLICT handling
-                try:
-                    # First, try to insert all records
-                    result = session.execute(insert(QuarterlyFinancial), records)
-                    loaded_count = len(records)
-                    
-                except IntegrityError as e:
-                    logger.info("Handling duplicate records with upsert logic")
-                    session.rollback()
-                    
-                    loaded_count = 0
-                    for record in records:
-                        try:
-                            existing = session.execute(
-                                select(QuarterlyFinancial).where(
-                                    QuarterlyFinancial.company_id == record['company_id'],
-                                    QuarterlyFinancial.quarter_date == record['quarter_date']
-                                )
-                            ).first()
-                            
-                            if existing:
-                                session.execute(
-                                    QuarterlyFinancial.__table__.update().where(
-                                        QuarterlyFinancial.id == existing.QuarterlyFinancial.id
-                                    ).values(**record)
-                                )
-                            else:
-                                session.execute(insert(QuarterlyFinancial), [record])
-                            loaded_count += 1
-                        except Exception as record_error:
-                            logger.warning(f"Failed to process record {record['quarter_label']}: {record_error}")
-                            continue
-                    session.commit()
+                _write_upsert(session, QuarterlyFinancial, ['revenue', 'eps', 'gross_profit', 'quarter_label'], records)
+                loaded_count = len(records)
                 
                 logger.info(f"Successfully loaded {loaded_count} financial records ({skipped} skipped)")
                 return loaded_count
@@ -167,33 +203,24 @@ class DatabaseLoader:
             return 0
         
         # Ensure companies are loaded first
-        unique_tickers = list(set([data.ticker for data in estimate_data]))
-        company_mapping = self.company_cache or self.load_companies(unique_tickers)
+        unique_tickers = list(dict.fromkeys(data.ticker for data in estimate_data))
+        company_mapping = self.get_company_ids(unique_tickers)
         
-        with self.get_session() as session:
+        records = [
+            {'company_id': company_mapping[data.ticker], **data.model_dump(exclude={'ticker'})}
+            for data in estimate_data if company_mapping.get(data.ticker)
+        ]
+        if not records:
+            return 0
+        records = _latest_per_quarter(records)
+        
+        with self.get_session(durable=False) as session:
             try:
-                records = []
-                for data in estimate_data:
-                    company_id = company_mapping.get(data.ticker)
-                    if not company_id:
-                        continue
-                    
-                    record = {
-                        'company_id': company_id,
-                        'quarter_date': data.quarter_date,
-                        'quarter_label': data.quarter_label,
-                        'estimated_revenue': float(data.estimated_revenue) if data.estimated_revenue else None,
-                        'estimated_eps': float(data.estimated_eps) if data.estimated_eps else None,
-                        'analyst_count': data.analyst_count
-                    }
-                    records.append(record)
-                
-                if records:
-                    session.execute(insert(AnalystEstimate), records)
-                    logger.info(f"Loaded {len(records)} analyst estimate records")
-                    return len(records)
-                
-                return 0
+                _write_upsert(
+                    session, AnalystEstimate, ['estimated_revenue', 'estimated_eps', 'analyst_count', 'quarter_label'], records
+                )
+                logger.info(f"Loaded {len(records)} analyst estimate records")
+                return len(records)
                 
             except Exception as e:
                 logger.error(f"Failed to load analyst estimates: {e}")
@@ -206,20 +233,16 @@ class DatabaseLoader:
             return 0
         
         try:
+            # Convert column-wise in pandas, then validate each record once
+            frame = df.assign(quarter_date=pd.to_datetime(df['quarter_date'], errors='coerce').dt.date).reindex(columns=DATAFRAME_COLUMNS)
+            records = frame.astype(object).where(frame.notna(), None).to_dict(orient='records')
+            
             financial_data = []
-            for _, row in df.iterrows():
+            for record in records:
                 try:
-                    revenue = Decimal(str(row['revenue'])) if pd.notnull(row['revenue']) else None
-                    eps = Decimal(str(row['eps'])) if pd.notnull(row['eps']) else None
-                    gross_profit = Decimal(str(row['gross_profit'])) if pd.notnull(row['gross_profit']) else None
-                    
-                    financial_data.append(FinancialData(
-                        ticker=row['ticker'], quarter_date=pd.to_datetime(row['quarter_date']).date(),
-                        quarter_label=row['quarter_label'], revenue=revenue, eps=eps, gross_profit=gross_profit
-                    ))
+                    financial_data.append(FinancialData(**record))
                 except Exception as e:
                     logger.warning(f"Failed to convert DataFrame row to FinancialData: {e}")
-                    continue
             return self.load_quarterly_financials(financial_data)
             
         except Exception as e:
@@ -230,17 +253,24 @@ class DatabaseLoader:
         """Get summary of loaded data for validation."""
         with self.get_session() as session:
             try:
-                company_counts = {}
-                companies = session.execute(select(Company)).fetchall()
-                
-                for company in companies:
-                    ticker = company.Company.ticker
-                    financial_count = session.execute(
-                        select(QuarterlyFinancial).where(QuarterlyFinancial.company_id == company.Company.id)
-                    ).fetchall()
-                    company_counts[ticker] = {'financial_records': len(financial_count), 'company_id': company.Company.id}
+                # Count server-side in one grouped query instead of fetching rows per company
+                financial_records = func.count(QuarterlyFinancial.id)
+                rows = session.execute(
+                    select(
+                        Company.ticker, Company.id, financial_records.label('financial_records'),
+                        func.sum(financial_records).over().label('total_financial_records')  # grand total, same scan
+                    )
+                    .outerjoin(QuarterlyFinancial, QuarterlyFinancial.company_id == Company.id)
+                    .group_by(Company.id, Company.ticker)
+                ).all()
+                company_counts = {
+                    row.ticker: {'financial_records': row.financial_records, 'company_id': row.id} for row in rows
+                }
                 
-                return {'total_companies': len(companies), 'company_breakdown': company_counts, 'last_updated': pd.Timestamp.now().isoformat()}
+                return {
+                    'total_companies': len(rows), 'total_financial_records': int(rows[0].total_financial_records) if rows else 0,
+                    'company_breakdown': company_counts, 'last_updated': pd.Timestamp.now().isoformat()
+                }
             except Exception as e:
                 logger.error(f"Failed to get data summary: {e}")
                 return {'error': str(e)}
@@ -249,23 +279,22 @@ class DatabaseLoader:
         """Validate Tesla Q2 2025 data in database matches expected values."""
         with self.get_session() as session:
             try:
-                tesla = session.execute(select(Company).where(Company.ticker == 'TSLA')).first()
-                if not tesla:
+                tesla_id = session.scalar(select(Company.id).where(Company.ticker == 'TSLA'))
+                if tesla_id is None:
                     logger.error("Tesla company not found in database")
                     return False
                 
-                tesla_q2_2025 = session.execute(
+                record = session.scalar(
                     select(QuarterlyFinancial).where(
-                        QuarterlyFinancial.company_id == tesla.Company.id,
+                        QuarterlyFinancial.company_id == tesla_id,
                         QuarterlyFinancial.quarter_label == '2025-Q2'
                     )
-                ).first()
+                )
                 
-                if not tesla_q2_2025:
+                if record is None:
                     logger.warning("Tesla Q2 2025 data not found in database")
                     return False
                 
-                record = tesla_q2_2025.QuarterlyFinancial
                 expected_revenue = 22500000000.0
                 tolerance_revenue = expected_revenue * 0.001
                 
@@ -288,8 +317,9 @@ class DatabaseLoader:
 
 
 if __name__ == "__main__":
+    setup_logging()
     loader = DatabaseLoader()
-    company_mapping = loader.load_companies(['TSLA', 'RIVN', 'LCID'])
+    company_mapping = loader.load_companies(COMPANY_TICKERS)
     print(f"Company mapping: {company_mapping}")
     summary = loader.get_data_summary()
     print(f"Data summary: {summary}")
\ No newline at end of file
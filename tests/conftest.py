@@ -0,0 +1,72 @@
+"""
+Shared pytest configuration for the ETL pipeline test suite.
+Blocks real network and database access so a missing mock fails fast instead of calling live services.
+"""
+import socket
+from unittest.mock import MagicMock, patch
+
+import pytest
+from sqlalchemy.orm import Session
+
+from load import DatabaseLoader
+from main import ETLPipeline
+
+
+def pytest_addoption(parser):
+    parser.addoption('--run-slow', action='store_true', help="also run tests marked slow")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "enable_socket: allow real network connections in this test")
+    config.addinivalue_line("markers", "slow: takes seconds rather than milliseconds; skipped unless --run-slow is given")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--run-slow'):
+        return
+    skip_slow = pytest.mark.skip(reason="slow test; pass --run-slow to include it")
+    for item in items:
+        if 'slow' in item.keywords:
+            item.add_marker(skip_slow)
+
+
+@pytest.fixture(autouse=True)
+def _disable_socket(request, monkeypatch):
+    """Make outbound socket connections and database sessions raise unless the test is marked enable_socket."""
+    if request.node.get_closest_marker('enable_socket'):
+        return
+
+    def guarded_connect(sock, address):
+        raise RuntimeError(f"Network access is disabled in tests (attempted {address})")
+
+    def guarded_session():
+        raise RuntimeError("Database access is disabled in tests; mock the DatabaseLoader methods used")
+
+    monkeypatch.setattr(socket.socket, 'connect', guarded_connect)
+    monkeypatch.setattr(socket.socket, 'connect_ex', guarded_connect)
+    # psycopg2 connects from C and bypasses socket.socket, so loaders get a session factory that refuses instead
+    monkeypatch.setattr('load.get_session_factory', lambda: guarded_session)
+
+
+@pytest.fixture
+def pipeline():
+    """Fresh ETL pipeline; its transformer and loader are only built on first use."""
+    return ETLPipeline()
+
+
+@pytest.fixture
+def loader():
+    """DatabaseLoader with a mocked session factory and an empty shared company cache."""
+    DatabaseLoader.clear_company_cache()
+    with patch('load.get_session_factory'):
+        yield DatabaseLoader()
+    DatabaseLoader.clear_company_cache()
+
+
+@pytest.fixture
+def session_mock():
+    """Session mock that works as its own context manager, as returned by DatabaseLoader.get_session."""
+    session = MagicMock(spec=Session)
+    session.__enter__.return_value = session
+    session.__exit__.return_value = None
+    return session
@@ -0,0 +1,69 @@
+"""
+Unit tests for cache.py module.
+Tests disk-backed response caching and TTL handling.
+"""
+import os
+import pytest
+from unittest.mock import patch
+
+from cache import FileCache
+
+
+class TestFileCache:
+    """Test the JSON file cache."""
+
+    @pytest.fixture
+    def cache(self, tmp_path):
+        """Create FileCache instance in a temporary directory."""
+        return FileCache(cache_dir=str(tmp_path / "fmp"))
+
+    def test_set_and_get_roundtrip(self, cache):
+        """Test cached payloads are returned unchanged."""
+        payload = [{"date": "2025-06-30", "revenue": 22500000000}]
+        cache.set("income-statement/TSLA", {"period": "quarter", "limit": 8}, payload)
+
+        assert cache.get("income-statement/TSLA", {"period": "quarter", "limit": 8}) == payload
+
+    def test_cache_miss(self, cache):
+        """Test unknown requests return None."""
+        assert cache.get("income-statement/TSLA", {"period": "quarter"}) is None
+
+    def test_api_key_excluded_from_key(self, cache):
+        """Test entries are shared regardless of the API key used."""
+        cache.set("income-statement/TSLA", {"period": "quarter", "apikey": "old"}, [{"a": 1}])
+
+        assert cache.get("income-statement/TSLA", {"period": "quarter", "apikey": "new"}) == [{"a": 1}]
+
+    def test_expired_entry_is_a_miss(self, cache):
+        """Test entries older than their TTL are not served."""
+        with patch('cache.time.time', return_value=1_000_000):
+            cache.set("analyst-estimates/TSLA", {"period": "quarter"}, [{"a": 1}])
+
+        with patch('cache.time.time', return_value=1_000_000 + 8 * 86400):
+            assert cache.get("analyst-estimates/TSLA", {"period": "quarter"}) is None
+
+    def test_get_stale_ignores_ttl(self, cache):
+        """Test expired entries remain available as a fallback."""
+        with patch('cache.time.time', return_value=1_000_000):
+            cache.set("analyst-estimates/TSLA", {"period": "quarter"}, [{"a": 1}])
+
+        with patch('cache.time.time', return_value=1_000_000 + 365 * 86400):
+            assert cache.get_stale("analyst-estimates/TSLA", {"period": "quarter"}) == [{"a": 1}]
+
+    def test_failed_write_leaves_no_temp_file(self, cache):
+        """Test a payload that cannot be serialised leaves neither an entry nor a temp file behind."""
+        with pytest.raises(TypeError):
+            cache.set("income-statement/TSLA", {"period": "quarter"}, [object()])
+
+        assert os.listdir(cache.cache_dir) == []
+        assert cache.get("income-statement/TSLA", {"period": "quarter"}) is None
+
+    def test_ttl_by_endpoint_root(self, cache):
+        """Test per-endpoint TTLs follow data cadence."""
+        assert cache.ttl_for("income-statement/TSLA") == 90 * 86400
+        assert cache.ttl_for("analyst-estimates/TSLA") == 7 * 86400
+        assert cache.ttl_for("profile/TSLA") == cache.default_ttl
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
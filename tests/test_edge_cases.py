@@ -3,21 +3,33 @@ Edge case tests for API failures, missing data, and error scenarios.
 Tests resilience and error handling across the ETL pipeline.
 """
 import pytest
-import json
-import os
-from unittest.mock import Mock, patch, mock_open
+import tracemalloc
+from unittest.mock import Mock, patch
 from datetime import date
 from decimal import Decimal
 
+import numpy as np
 import pandas as pd
 import requests
 
 from extract import FMPExtractor, YFinanceExtractor, extract_all_companies, RateLimitError, APIError
 from transform import DataTransformer, ValidationError
-from load import DatabaseLoader, LoadError
+from load import LoadError
 from config import FinancialData
 
 
+@pytest.fixture(scope="module")
+def mk_response():
+    """Build FMP responses specced against requests.Response."""
+    def _mk(content=b'[]', status=200, error=None):
+        response = Mock(spec=requests.Response)
+        response.status_code = status
+        response.content = content
+        response.raise_for_status.side_effect = error
+        return response
+    return _mk
+
+
 class TestAPIFailureScenarios:
     """Test various API failure scenarios."""
     
@@ -29,14 +41,18 @@ class TestAPIFailureScenarios:
     def yf_extractor(self):
         return YFinanceExtractor()
     
-    def test_fmp_authentication_failure(self, fmp_extractor):
-        """Test FMP API authentication failure."""
-        mock_response = Mock()
-        mock_response.status_code = 401
-        mock_response.json.return_value = {"error": "Invalid API key"}
-        mock_response.raise_for_status.side_effect = requests.exceptions.HTTPError("401 Unauthorized")
-        
-        fmp_extractor.session.get = Mock(return_value=mock_response)
+    @pytest.mark.parametrize("status, error", [
+        (401, requests.exceptions.HTTPError("401 Unauthorized")),
+        (500, requests.exceptions.HTTPError("500 Internal Server Error")),
+        (None, requests.exceptions.Timeout("Request timed out")),
+        (None, requests.exceptions.ConnectionError("Network unreachable")),
+    ], ids=['authentication', 'server_error', 'network_timeout', 'connection_error'])
+    def test_fmp_request_failure(self, fmp_extractor, mk_response, status, error):
+        """Test HTTP errors and transport failures all surface as APIError."""
+        if status is None:
+            fmp_extractor.session.get = Mock(side_effect=error)
+        else:
+            fmp_extractor.session.get = Mock(return_value=mk_response(status=status, error=error))
         
         with pytest.raises(APIError, match="Failed to fetch data"):
             fmp_extractor.get_quarterly_income_statement("TSLA")
@@ -48,31 +64,6 @@ class TestAPIFailureScenarios:
         with pytest.raises(RateLimitError, match="Daily API limit"):
             fmp_extractor._check_rate_limit()
     
-    def test_fmp_network_timeout(self, fmp_extractor):
-        """Test network timeout scenarios."""
-        fmp_extractor.session.get = Mock(side_effect=requests.exceptions.Timeout("Request timed out"))
-        
-        with pytest.raises(APIError, match="Failed to fetch data"):
-            fmp_extractor.get_quarterly_income_statement("TSLA")
-    
-    def test_fmp_connection_error(self, fmp_extractor):
-        """Test network connection errors."""
-        fmp_extractor.session.get = Mock(side_effect=requests.exceptions.ConnectionError("Network unreachable"))
-        
-        with pytest.raises(APIError, match="Failed to fetch data"):
-            fmp_extractor.get_quarterly_income_statement("TSLA")
-    
-    def test_fmp_server_error(self, fmp_extractor):
-        """Test server-side errors (5xx)."""
-        mock_response = Mock()
-        mock_response.status_code = 500
-        mock_response.raise_for_status.side_effect = requests.exceptions.HTTPError("500 Internal Server Error")
-        
-        fmp_extractor.session.get = Mock(return_value=mock_response)
-        
-        with pytest.raises(APIError, match="Failed to fetch data"):
-            fmp_extractor.get_quarterly_income_statement("TSLA")
-    
     @patch('extract.yf.Ticker')
     def test_yfinance_data_access_error(self, mock_ticker, yf_extractor):
         """Test yfinance data access errors."""
@@ -105,25 +96,18 @@ class TestMissingDataScenarios:
     def fmp_extractor(self):
         return FMPExtractor(api_key="test_key")
     
-    def test_fmp_empty_response(self, fmp_extractor):
+    def test_fmp_empty_response(self, fmp_extractor, mk_response):
         """Test FMP API returning empty response."""
-        mock_response = Mock()
-        mock_response.json.return_value = []  # Empty list
-        mock_response.raise_for_status.return_value = None
-        
-        fmp_extractor.session.get = Mock(return_value=mock_response)
+        fmp_extractor.session.get = Mock(return_value=mk_response(b'[]'))  # Empty list
         
-        # Should handle empty response gracefully
-        result = fmp_extractor.get_quarterly_income_statement("UNKNOWN_TICKER")
-        assert result == []
+        # Should handle empty response gracefully; _make_request normalises it to {}
+        with patch('extract._save_raw'):
+            result = fmp_extractor.get_quarterly_income_statement("UNKNOWN_TICKER")
+        assert result == {}
     
-    def test_fmp_malformed_json(self, fmp_extractor):
+    def test_fmp_malformed_json(self, fmp_extractor, mk_response):
         """Test FMP API returning malformed JSON."""
-        mock_response = Mock()
-        mock_response.json.side_effect = json.JSONDecodeError("Invalid JSON", "", 0)
-        mock_response.raise_for_status.return_value = None
-        
-        fmp_extractor.session.get = Mock(return_value=mock_response)
+        fmp_extractor.session.get = Mock(return_value=mk_response(b'{"Invalid JSON'))
         
         with pytest.raises(APIError, match="Failed to fetch data"):
             fmp_extractor.get_quarterly_income_statement("TSLA")
@@ -214,81 +198,88 @@ class TestFileSystemEdgeCases:
         return FMPExtractor(api_key="test_key")
     
     @patch('extract.os.makedirs')
-    def test_directory_creation_permission_error(self, mock_makedirs, fmp_extractor):
-        """Test handling of directory creation permission errors."""
+    def test_directory_creation_permission_error(self, mock_makedirs):
+        """Test an uncreatable raw data directory fails extractor construction, where it is created."""
         mock_makedirs.side_effect = PermissionError("Permission denied")
         
-        mock_response = Mock()
-        mock_response.json.return_value = [{"test": "data"}]
-        mock_response.raise_for_status.return_value = None
-        fmp_extractor.session.get = Mock(return_value=mock_response)
-        
-        with pytest.raises(APIError, match="Failed to fetch data"):
-            fmp_extractor.get_quarterly_income_statement("TSLA")
+        with pytest.raises(PermissionError, match="Permission denied"):
+            FMPExtractor(api_key="test_key")
     
     @patch('builtins.open')
-    def test_file_write_permission_error(self, mock_open_func, fmp_extractor):
-        """Test handling of file write permission errors."""
+    def test_file_write_permission_error(self, mock_open_func, fmp_extractor, mk_response):
+        """Test a raw snapshot write error reaches the caller; it is not an API failure."""
         mock_open_func.side_effect = PermissionError("Permission denied")
         
-        mock_response = Mock()
-        mock_response.json.return_value = [{"test": "data"}]
-        mock_response.raise_for_status.return_value = None
-        fmp_extractor.session.get = Mock(return_value=mock_response)
+        fmp_extractor.session.get = Mock(return_value=mk_response(b'[{"test": "data"}]'))
         
         with patch('extract.os.makedirs'):  # Allow directory creation
-            with pytest.raises(APIError, match="Failed to fetch data"):
+            with pytest.raises(PermissionError, match="Permission denied"):
                 fmp_extractor.get_quarterly_income_statement("TSLA")
     
     @patch('builtins.open')
-    def test_disk_full_error(self, mock_open_func, fmp_extractor):
-        """Test handling of disk full errors."""
+    def test_disk_full_error(self, mock_open_func, fmp_extractor, mk_response):
+        """Test a full disk while saving the raw snapshot raises OSError to the caller."""
         mock_open_func.side_effect = OSError("No space left on device")
         
-        mock_response = Mock()
-        mock_response.json.return_value = [{"test": "data"}]
-        mock_response.raise_for_status.return_value = None
-        fmp_extractor.session.get = Mock(return_value=mock_response)
+        fmp_extractor.session.get = Mock(return_value=mk_response(b'[{"test": "data"}]'))
         
         with patch('extract.os.makedirs'):
-            with pytest.raises(APIError, match="Failed to fetch data"):
+            with pytest.raises(OSError, match="No space left on device"):
                 fmp_extractor.get_quarterly_income_statement("TSLA")
 
 
+class FakeSession:
+    """In-memory stand-in for the parts of a SQLAlchemy session the loader uses."""
+    
+    def __init__(self, execute_raises: Exception = None, commit_raises: Exception = None):
+        self.execute_raises = execute_raises
+        self.commit_raises = commit_raises
+        self.rollback_called = False
+        self.closed = False
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return None
+    
+    def execute(self, *args, **kwargs):
+        if self.execute_raises:
+            raise self.execute_raises
+    
+    def commit(self):
+        if self.commit_raises:
+            raise self.commit_raises
+    
+    def rollback(self):
+        self.rollback_called = True
+    
+    def close(self):
+        self.closed = True
+
+
 class TestDatabaseEdgeCases:
     """Test database-related edge cases."""
     
-    @pytest.fixture
-    def loader(self):
-        with patch('load.get_session_factory'):
-            return DatabaseLoader()
-    
     def test_database_connection_timeout(self, loader):
         """Test database connection timeout."""
-        mock_session = Mock()
-        mock_session.__enter__ = Mock(return_value=mock_session)
-        mock_session.__exit__ = Mock(return_value=None)
-        mock_session.execute.side_effect = Exception("Connection timeout")
-        
-        loader.get_session = Mock(return_value=mock_session)
+        fake_session = FakeSession(execute_raises=Exception("Connection timeout"))
+        loader.get_session = lambda *args, **kwargs: fake_session
         
         with pytest.raises(LoadError, match="Company loading failed"):
             loader.load_companies(['TSLA'])
     
     def test_database_transaction_rollback(self, loader):
         """Test database transaction rollback on error."""
-        mock_session = Mock()
-        mock_session.__enter__ = Mock(return_value=mock_session)
-        mock_session.__exit__ = Mock(return_value=None)
-        mock_session.commit.side_effect = Exception("Commit failed")
-        
-        loader.session_factory = Mock(return_value=mock_session)
+        fake_session = FakeSession(commit_raises=Exception("Commit failed"))
+        loader.session_factory = lambda: fake_session
         
         with pytest.raises(Exception, match="Commit failed"):
             with loader.get_session() as session:
                 pass  # Trigger commit in context manager
         
-        mock_session.rollback.assert_called_once()
+        assert fake_session.rollback_called
+        assert fake_session.closed
     
     def test_invalid_company_mapping(self, loader):
         """Test handling of invalid company mappings."""
@@ -347,38 +338,32 @@ class TestDataValidationEdgeCases:
         result = transformer.validate_tesla_q2_2025(tesla_data_precision)
         assert result == True
     
-    def test_quarter_standardization_edge_cases(self, transformer):
-        """Test quarter standardization with edge cases."""
-        # Test various edge cases for date parsing
-        test_cases = [
-            ("", None),
-            (None, None),
-            ("2025-13-31", None),    # Invalid month
-            ("2025-02-30", None),    # Invalid date
-            ("not-a-date", None),    # Invalid format
-            ("2025/12/31", "2025-Q4"),  # Different format should work
-        ]
-        
-        for input_date, expected in test_cases:
-            result = transformer.standardize_quarter_date(input_date)
-            assert result == expected
-    
-    def test_decimal_conversion_edge_cases(self, transformer):
+    @pytest.mark.parametrize("input_date, expected", [
+        ("", None),
+        (None, None),
+        ("2025-13-31", None),    # Invalid month
+        ("2025-02-30", None),    # Invalid date
+        ("not-a-date", None),    # Invalid format
+        ("2025/12/31", "2025-Q4"),  # Different format should work
+    ])
+    def test_quarter_standardization_edge_cases(self, transformer, input_date, expected):
+        """Test quarter standardization with edge cases, per value and in batch."""
+        assert transformer.standardize_quarter_date(input_date) == expected
+        assert transformer.standardize_quarter_dates([input_date]) == [expected]
+    
+    @pytest.mark.parametrize("input_val, expected", [
+        (float('inf'), None),     # Infinity
+        (float('-inf'), None),    # Negative infinity
+        (float('nan'), None),     # NaN
+        ("", None),               # Empty string
+        ("invalid", None),        # Invalid string
+        (None, None),             # None input
+        (0, Decimal('0')),        # Zero
+        (-1000000, Decimal('-1000000')),  # Negative
+    ])
+    def test_decimal_conversion_edge_cases(self, transformer, input_val, expected):
         """Test decimal conversion with various edge cases."""
-        test_cases = [
-            (float('inf'), None),     # Infinity
-            (float('-inf'), None),    # Negative infinity
-            (float('nan'), None),     # NaN
-            ("", None),               # Empty string
-            ("invalid", None),        # Invalid string
-            (None, None),             # None input
-            (0, Decimal('0')),        # Zero
-            (-1000000, Decimal('-1000000')),  # Negative
-        ]
-        
-        for input_val, expected in test_cases:
-            result = transformer._safe_decimal_convert(input_val)
-            assert result == expected
+        assert transformer._safe_decimal_convert(input_val) == expected
 
 
 class TestOrchestrationEdgeCases:
@@ -392,6 +377,7 @@ class TestOrchestrationEdgeCases:
         mock_fmp_instance = Mock()
         mock_fmp_instance.get_quarterly_income_statement.side_effect = RateLimitError("Rate limited")
         mock_fmp_instance.get_analyst_estimates.side_effect = RateLimitError("Rate limited") 
+        mock_fmp_instance.get_stale_data.return_value = None  # nothing cached
         mock_fmp.return_value = mock_fmp_instance
         
         mock_yf_instance = Mock()
@@ -406,12 +392,12 @@ class TestOrchestrationEdgeCases:
     
     @patch('extract.FMPExtractor')
     @patch('extract.YFinanceExtractor')
-    @patch('extract.time.sleep')  # Mock sleep to speed up tests
-    def test_retry_logic_exhaustion(self, mock_sleep, mock_yf, mock_fmp):
+    def test_retry_logic_exhaustion(self, mock_yf, mock_fmp):
         """Test that retry logic eventually gives up."""
         # Mock FMP failing consistently
         mock_fmp_instance = Mock()
         mock_fmp_instance.get_quarterly_income_statement.side_effect = APIError("Persistent error")
+        mock_fmp_instance.get_stale_data.return_value = None  # nothing cached
         mock_fmp.return_value = mock_fmp_instance
         
         # Mock yfinance also failing
@@ -423,29 +409,35 @@ class TestOrchestrationEdgeCases:
         
         # Should eventually give up and mark as failed
         assert result['TSLA']['status'] == 'failed'
-        # Verify sleep was called (indicating retries happened)
-        assert mock_sleep.call_count > 0
+        # Verify the yfinance fallback was attempted before giving up
+        mock_yf_instance.get_quarterly_income_statement.assert_called_once_with('TSLA')
     
+    @pytest.mark.slow
     def test_memory_pressure_large_dataset(self):
         """Test handling of large datasets that might cause memory pressure."""
-        # Create a large amount of mock data
-        large_dataset = []
-        for i in range(10000):  # 10k records
-            large_dataset.append({
-                "date": "2025-06-30",
-                "symbol": "TSLA",
-                "revenue": 22500000000 + i,
-                "eps": 0.40,
-                "grossProfit": 5000000000 + i
-            })
+        # Create a large amount of mock data, one array per column
+        n = 10000  # 10k records
+        large_dataset = pd.DataFrame({
+            "date": np.full(n, "2025-06-30"),
+            "symbol": np.full(n, "TSLA"),
+            "revenue": 22_500_000_000 + np.arange(n),
+            "eps": np.full(n, 0.40),
+            "grossProfit": 5_000_000_000 + np.arange(n)
+        })
         
         transformer = DataTransformer()
         
         # Should handle large datasets without memory errors
-        result = transformer.extract_core_metrics(large_dataset, "TSLA", "fmp")
+        tracemalloc.start()
+        try:
+            result = transformer.extract_core_metrics(large_dataset, "TSLA", "fmp")
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
         
         assert len(result) == 10000
         assert all(isinstance(item, FinancialData) for item in result)
+        assert peak < 50 * 1024 * 1024
 
 
 if __name__ == "__main__":
@@ -4,10 +4,22 @@ Tests API extraction functionality with mocked responses.
 """
 import json
 import pytest
-from unittest.mock import Mock, patch, mock_open
-from decimal import Decimal
+import requests
+from unittest.mock import Mock, patch
+from urllib3.response import HTTPResponse
 
-from extract import FMPExtractor, YFinanceExtractor, extract_all_companies, RateLimitError, APIError
+from cache import FileCache
+from extract import (
+    FMPExtractor, YFinanceExtractor, TokenBucket, CircuitBreaker, extract_all_companies, iter_extract_all,
+    RateLimitError, APIError, CircuitOpenError, CIRCUIT_FAILURE_THRESHOLD
+)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run the test from a temporary directory so raw files are written for real."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
 
 
 class TestFMPExtractor:
@@ -45,14 +57,66 @@ class TestFMPExtractor:
         with pytest.raises(RateLimitError, match="Daily API limit"):
             extractor._check_rate_limit()
     
-    @patch('extract.os.makedirs')
-    @patch('builtins.open', new_callable=mock_open)
-    @patch('extract.json.dump')
-    def test_get_quarterly_income_statement_success(self, mock_json_dump, mock_file, mock_makedirs, extractor, mock_response_data):
+    def test_session_retry_honours_retry_after(self, extractor):
+        """Test the session retries idempotent GETs and respects Retry-After."""
+        retry = extractor.session.get_adapter("https://financialmodelingprep.com").max_retries
+        
+        assert retry.respect_retry_after_header is True
+        assert 429 in retry.status_forcelist
+        assert retry.allowed_methods == {'GET'}
+    
+    def test_session_retry_caps_retry_after(self, extractor):
+        """Test a long Retry-After is clamped to backoff_max instead of blocking the worker."""
+        retry = extractor.session.get_adapter("https://financialmodelingprep.com").max_retries
+        
+        assert retry.get_retry_after(HTTPResponse(status=429, headers={'Retry-After': '3600'})) == retry.backoff_max
+        assert retry.get_retry_after(HTTPResponse(status=429, headers={'Retry-After': '2'})) == 2
+    
+    def test_circuit_opens_after_n_failures(self, extractor):
+        """Test the call after the failure threshold fails fast without touching the network."""
+        extractor.session.get = Mock(side_effect=requests.exceptions.ConnectionError("down"))
+        
+        for _ in range(CIRCUIT_FAILURE_THRESHOLD):
+            with pytest.raises(APIError, match="Failed to fetch data"):
+                extractor.get_quarterly_income_statement("TSLA")
+        
+        with pytest.raises(CircuitOpenError):
+            extractor.get_quarterly_income_statement("TSLA")
+        assert extractor.session.get.call_count == CIRCUIT_FAILURE_THRESHOLD
+        assert extractor.daily_calls == CIRCUIT_FAILURE_THRESHOLD
+    
+    def test_circuit_half_open_after_reset_timeout(self):
+        """Test a successful trial call after the cool-down closes the circuit."""
+        breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=10)
+        with patch('extract.time.monotonic', return_value=100.0):
+            breaker.record_failure()
+            with pytest.raises(CircuitOpenError):
+                breaker.before_call()
+        
+        with patch('extract.time.monotonic', return_value=110.0):
+            breaker.before_call()
+        breaker.record_success()
+        
+        assert breaker.state == CircuitBreaker.CLOSED
+    
+    def test_token_bucket_waits_once_drained(self):
+        """Test the bucket serves a burst up to capacity, then paces callers at its rate."""
+        with patch('extract.time.monotonic', return_value=100.0), patch('extract.time.sleep') as mock_sleep:
+            bucket = TokenBucket(rate=2)
+            bucket.take()
+            bucket.take()
+            mock_sleep.assert_not_called()
+            
+            bucket.take()
+            bucket.take()
+        
+        assert [c.args[0] for c in mock_sleep.call_args_list] == [0.5, 1.0]
+    
+    def test_get_quarterly_income_statement_success(self, workdir, extractor, mock_response_data):
         """Test successful quarterly income statement extraction."""
         # Mock the session.get call
         mock_response = Mock()
-        mock_response.json.return_value = mock_response_data
+        mock_response.content = json.dumps(mock_response_data).encode()
         mock_response.raise_for_status.return_value = None
         
         extractor.session.get = Mock(return_value=mock_response)
@@ -62,17 +126,35 @@ class TestFMPExtractor:
         # Assertions
         assert result == mock_response_data
         assert extractor.daily_calls == 1
-        mock_makedirs.assert_called_once_with('data/raw', exist_ok=True)
-        mock_file.assert_called_once_with('data/raw/TSLA_income_raw.json', 'w')
-        mock_json_dump.assert_called_once()
+        raw_file = workdir / 'data' / 'raw' / 'TSLA_income_raw.json'
+        assert json.loads(raw_file.read_bytes()) == mock_response_data
     
-    @patch('extract.requests.exceptions.RequestException')
-    def test_api_request_failure(self, mock_exception, extractor):
-        """Test API request failure handling."""
-        extractor.session.get = Mock(side_effect=mock_exception("Network error"))
+    def test_cache_hit_skips_network(self, tmp_path, mock_response_data):
+        """Test fresh cache entries are served without an API call."""
+        cache = FileCache(cache_dir=str(tmp_path))
+        cache.set("income-statement/TSLA", {"period": "quarter", "limit": 8}, mock_response_data)
+        extractor = FMPExtractor(api_key="test_key", rate_limit=10, cache=cache)
+        extractor.session.get = Mock()
         
-        with pytest.raises(APIError, match="Failed to fetch data"):
-            extractor.get_quarterly_income_statement("TSLA")
+        with patch('extract._save_raw'):
+            result = extractor.get_quarterly_income_statement("TSLA")
+        
+        assert result == mock_response_data
+        assert extractor.daily_calls == 0
+        extractor.session.get.assert_not_called()
+    
+    def test_cache_write_failure_still_returns_data(self, tmp_path, mock_response_data):
+        """Test a failed cache write is logged and the fetched payload is still returned."""
+        cache = FileCache(cache_dir=str(tmp_path))
+        cache.set = Mock(side_effect=OSError(28, "No space left on device"))
+        extractor = FMPExtractor(api_key="test_key", rate_limit=10, cache=cache)
+        extractor.session.get = Mock(return_value=Mock(content=json.dumps(mock_response_data).encode()))
+        
+        with patch('extract._save_raw'):
+            result = extractor.get_quarterly_income_statement("TSLA")
+        
+        assert result == mock_response_data
+        cache.set.assert_called_once()
 
 
 class TestYFinanceExtractor:
@@ -96,11 +178,8 @@ class TestYFinanceExtractor:
         
         return data
     
-    @patch('extract.os.makedirs')
-    @patch('builtins.open', new_callable=mock_open)
-    @patch('extract.json.dump')
     @patch('extract.yf.Ticker')
-    def test_yfinance_extraction_success(self, mock_ticker, mock_json_dump, mock_file, mock_makedirs, extractor, mock_yf_data):
+    def test_yfinance_extraction_success(self, mock_ticker, workdir, extractor, mock_yf_data):
         """Test successful yfinance data extraction."""
         # Mock yfinance ticker
         mock_ticker_instance = Mock()
@@ -113,7 +192,47 @@ class TestYFinanceExtractor:
         assert isinstance(result, list)
         assert len(result) > 0
         assert result[0]['symbol'] == 'TSLA'
-        mock_makedirs.assert_called_once_with('data/raw', exist_ok=True)
+        assert {'date', 'symbol', 'period', 'calendarYear', 'revenue', 'grossProfit', 'netIncome'} <= result[0].keys()
+        raw_file = workdir / 'data' / 'raw' / 'TSLA_income_yf_raw.json'
+        assert json.loads(raw_file.read_bytes()) == result
+    
+    @patch('extract._save_raw')
+    @patch('extract.yf.Ticker')
+    def test_yfinance_statement_memoized(self, mock_ticker, mock_save, extractor, mock_yf_data):
+        """Test repeated calls in one run reuse the fetched statement."""
+        mock_ticker.return_value.quarterly_income_stmt = mock_yf_data
+        
+        first = extractor.get_quarterly_income_statement("TSLA")
+        second = extractor.get_quarterly_income_statement("TSLA")
+        
+        assert first == second
+        mock_ticker.assert_called_once_with("TSLA")
+    
+    @patch('extract._save_raw')
+    @patch('extract.yf.Ticker')
+    def test_yfinance_statement_served_from_disk_cache(self, mock_ticker, mock_save, mock_yf_data, tmp_path):
+        """Test a fresh on-disk copy avoids the yfinance download."""
+        mock_ticker.return_value.quarterly_income_stmt = mock_yf_data
+        cache = FileCache(cache_dir=str(tmp_path))
+        
+        fetched = YFinanceExtractor(cache=cache).get_quarterly_income_statement("TSLA")
+        cached = YFinanceExtractor(cache=cache).get_quarterly_income_statement("TSLA")
+        
+        assert cached == fetched
+        mock_ticker.assert_called_once_with("TSLA")
+    
+    def test_format_yfinance_data_missing_row(self, extractor, mock_yf_data):
+        """Test missing metrics become None and zero values are kept."""
+        data = mock_yf_data.drop('Gross Profit')
+        data.loc['Net Income'] = [0, 900000000]
+        
+        result = extractor._format_yfinance_data(data, "TSLA")
+        
+        assert [r['date'] for r in result] == ['2025-06-30', '2025-03-31']
+        assert result[0]['revenue'] == 22500000000.0
+        assert result[0]['grossProfit'] is None
+        assert result[0]['netIncome'] == 0.0
+        assert result[0]['calendarYear'] == 2025
     
     @patch('extract.yf.Ticker')
     def test_yfinance_empty_data(self, mock_ticker, extractor):
@@ -159,6 +278,7 @@ class TestExtractAllCompanies:
         # Mock FMP failure
         mock_fmp_instance = Mock()
         mock_fmp_instance.get_quarterly_income_statement.side_effect = RateLimitError("Rate limit exceeded")
+        mock_fmp_instance.get_stale_data.return_value = None  # nothing cached
         mock_fmp.return_value = mock_fmp_instance
         
         # Mock yfinance success
@@ -173,14 +293,32 @@ class TestExtractAllCompanies:
         assert result['TSLA']['source'] == 'yfinance'
         assert result['TSLA']['income_data'] == {"data": "yfinance"}
     
-    @patch('extract.time.sleep')  # Mock sleep to speed up tests
     @patch('extract.YFinanceExtractor')
     @patch('extract.FMPExtractor')
-    def test_extract_complete_failure(self, mock_fmp, mock_yf, mock_sleep):
+    def test_extract_serves_stale_cache_before_yfinance(self, mock_fmp, mock_yf):
+        """Test expired cached FMP data is preferred over the yfinance fallback."""
+        mock_fmp_instance = Mock()
+        mock_fmp_instance.get_quarterly_income_statement.side_effect = RateLimitError("Rate limit exceeded")
+        mock_fmp_instance.get_stale_data.return_value = {
+            'income_data': [{"data": "cached income"}], 'estimates_data': [{"data": "cached estimates"}]
+        }
+        mock_fmp.return_value = mock_fmp_instance
+        
+        result = extract_all_companies(['TSLA'])
+        
+        assert result['TSLA']['status'] == 'stale'
+        assert result['TSLA']['source'] == 'fmp'
+        assert result['TSLA']['estimates_data'] == [{"data": "cached estimates"}]
+        mock_yf.return_value.get_quarterly_income_statement.assert_not_called()
+    
+    @patch('extract.YFinanceExtractor')
+    @patch('extract.FMPExtractor')
+    def test_extract_complete_failure(self, mock_fmp, mock_yf):
         """Test complete extraction failure for a company."""
         # Mock both extractors failing
         mock_fmp_instance = Mock()
         mock_fmp_instance.get_quarterly_income_statement.side_effect = APIError("API Error")
+        mock_fmp_instance.get_stale_data.return_value = None  # nothing cached
         mock_fmp.return_value = mock_fmp_instance
         
         mock_yf_instance = Mock()
@@ -192,6 +330,50 @@ class TestExtractAllCompanies:
         # Assertions
         assert result['TSLA']['status'] == 'failed'
         assert len(result['TSLA']['errors']) > 0
+    
+    @patch('extract.YFinanceExtractor')
+    @patch('extract.FMPExtractor')
+    def test_extract_multiple_tickers_preserves_order(self, mock_fmp, mock_yf):
+        """Test concurrent extraction returns one result per ticker in request order."""
+        mock_fmp_instance = Mock()
+        mock_fmp_instance.get_quarterly_income_statement.side_effect = lambda ticker: [{"symbol": ticker}]
+        mock_fmp_instance.get_analyst_estimates.return_value = []
+        mock_fmp.return_value = mock_fmp_instance
+        
+        result = extract_all_companies(['TSLA', 'RIVN', 'LCID'])
+        
+        assert list(result.keys()) == ['TSLA', 'RIVN', 'LCID']
+        assert all(r['status'] == 'success' for r in result.values())
+        assert result['RIVN']['income_data'] == [{"symbol": "RIVN"}]
+    
+    @patch('extract.YFinanceExtractor')
+    @patch('extract.FMPExtractor')
+    def test_iter_extract_all_yields_each_ticker(self, mock_fmp, mock_yf):
+        """Test the streaming variant yields every ticker once as it completes."""
+        mock_fmp_instance = Mock()
+        mock_fmp_instance.get_quarterly_income_statement.side_effect = lambda ticker: [{"symbol": ticker}]
+        mock_fmp_instance.get_analyst_estimates.return_value = []
+        mock_fmp.return_value = mock_fmp_instance
+        
+        results = dict(iter_extract_all(['TSLA', 'RIVN', 'TSLA']))
+        
+        assert sorted(results) == ['RIVN', 'TSLA']
+        assert results['TSLA']['income_data'] == [{"symbol": "TSLA"}]
+        assert mock_fmp_instance.get_quarterly_income_statement.call_count == 2
+    
+    @patch('extract.FileCache')
+    @patch('extract.YFinanceExtractor')
+    @patch('extract.FMPExtractor')
+    def test_extract_without_cache(self, mock_fmp, mock_yf, mock_cache):
+        """Test use_cache=False builds extractors with no response cache."""
+        mock_fmp.return_value.get_quarterly_income_statement.return_value = []
+        mock_fmp.return_value.get_analyst_estimates.return_value = []
+        
+        extract_all_companies(['TSLA'], use_cache=False)
+        
+        mock_cache.assert_not_called()
+        mock_fmp.assert_called_once_with(cache=None)
+        mock_yf.assert_called_once_with(cache=None)
 
 
 if __name__ == "__main__":
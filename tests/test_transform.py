@@ -7,7 +7,7 @@ import pandas as pd
 from datetime import date, datetime
 from decimal import Decimal
 
-from transform import DataTransformer, ValidationError
+from transform import DataTransformer, ValidationError, _decimal_from_str, _strptime_first
 from config import FinancialData
 
 
@@ -81,6 +81,23 @@ class TestQuarterStandardization:
         # Test with different date formats
         assert transformer.standardize_quarter_date("06/30/2025") == "2025-Q2"
     
+    def test_repeated_dates_parsed_once(self, transformer):
+        """Test repeated date strings are served from the parse cache."""
+        _strptime_first.cache_clear()
+        
+        for _ in range(3):
+            assert transformer.standardize_quarter_date("2025-06-30") == "2025-Q2"
+        
+        assert _strptime_first.cache_info().misses == 1
+        assert _strptime_first.cache_info().hits == 2
+    
+    def test_batch_standardization_matches_scalar(self, transformer):
+        """Test the vectorized quarter labels agree with the per-value method."""
+        values = ["2025-06-30", "2025-01-01 00:00:00", date(2024, 12, 31), datetime(2025, 9, 30), None, "not a date",
+                  "31/12/2025", "2025/12/31", "20251231", "2025-12", "12-31-2025", 2025]
+        
+        assert transformer.standardize_quarter_dates(values) == [transformer.standardize_quarter_date(v) for v in values]
+    
     def test_quarter_boundary_dates(self, transformer):
         """Test quarter boundary dates."""
         # Q1 boundaries
@@ -190,6 +207,25 @@ class TestDataTransformation:
         assert transformer._safe_decimal_convert("N/A") is None
         assert transformer._safe_decimal_convert("invalid") is None
     
+    def test_repeated_strings_converted_once(self, transformer):
+        """Test repeated numeric strings are served from the conversion cache."""
+        _decimal_from_str.cache_clear()
+        
+        assert [transformer._safe_decimal_convert("N/A") for _ in range(3)] == [None] * 3
+        assert transformer._safe_decimal_convert("$2,000,000") == Decimal('2000000')
+        
+        assert _decimal_from_str.cache_info().misses == 2
+        assert _decimal_from_str.cache_info().hits == 2
+    
+    def test_eps_not_scaled_as_millions(self, transformer):
+        """Test per-share EPS keeps its value while amounts under 1M are still read as millions."""
+        records = [{"date": "2025-06-30", "revenue": 22.5, "eps": 0.3709}]
+        
+        for raw_data in (records, pd.DataFrame(records)):
+            result = transformer.extract_core_metrics(raw_data, "TSLA", "fmp")[0]
+            assert result.eps == Decimal('0.3709')
+            assert result.revenue == Decimal('22500000')
+    
     def test_extract_core_metrics_fmp(self, transformer, sample_fmp_data):
         """Test extracting core metrics from FMP data."""
         results = transformer.extract_core_metrics(sample_fmp_data, "TSLA", "fmp")
@@ -208,6 +244,33 @@ class TestDataTransformation:
         results = transformer.extract_core_metrics(None, "TSLA", "fmp")
         assert results == []
     
+    def test_extract_core_metrics_dataframe_matches_records(self, transformer):
+        """Test the bulk DataFrame path produces the same records as the per-row path."""
+        records = [
+            {"date": "2025-06-30", "revenue": 22500000000, "eps": 0.40, "grossProfit": "$5,000,000,000"},
+            {"date": "2025-03-31", "revenue": None, "netIncomePerShare": 0.12, "grossProfit": "N/A"},
+            {"date": "not a date", "revenue": 1},
+            {"date": "20251231", "revenue": 1},
+            {"date": "2025/09/30", "revenue": 2},
+            {"date": "2025-W26-1", "revenue": 1},
+            {"date": "12/31/2024", "revenue": 33.3, "eps": 0, "netIncomePerShare": 0.25},
+            {"calendarYear": 2024, "revenue": 95.5, "eps": 0.9, "grossProfit": 20}
+        ]
+        
+        expected = transformer.extract_core_metrics(records, "TSLA", "fmp")
+        results = transformer.extract_core_metrics(pd.DataFrame(records), "TSLA", "fmp")
+        
+        assert len(results) == 5
+        assert [r.model_dump() for r in results] == [r.model_dump() for r in expected]
+    
+    def test_extract_core_metrics_accepts_iterator(self, transformer):
+        """Test records can be streamed in from any iterable."""
+        rows = ({"date": f"2025-0{month}-28", "revenue": 1000000000 * month} for month in (3, 6))
+        
+        results = transformer.extract_core_metrics(rows, "TSLA", "fmp")
+        
+        assert [r.quarter_label for r in results] == ["2025-Q1", "2025-Q2"]
+    
     def test_to_dataframe_conversion(self, transformer):
         """Test conversion to pandas DataFrame."""
         financial_data = [FinancialData(
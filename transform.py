@@ -2,20 +2,88 @@
 Data transformation module for Tesla Competitive Intelligence ETL Pipeline.
 Standardizes financial data across different API sources and validates data quality.
 """
+import itertools
 import logging
-import re
+import math
+import string
 from datetime import datetime, date
 from decimal import Decimal, InvalidOperation
-from typing import Dict, List, Optional, Any, Union
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Any, Tuple, Union
 
 import pandas as pd
 
-from config import setup_logging, FinancialData
+from config import setup_logging, FinancialData, USABLE_STATUSES
 
-# Setup logging
-setup_logging()
 logger = logging.getLogger(__name__)
 
+# Date string formats, tried in order
+QUARTER_DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y/%m/%d', '%m/%d/%Y', '%d/%m/%Y')
+PARSE_DATE_FORMATS = ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%Y/%m/%d', '%m/%d/%Y')
+MONTH_QUARTERS = (None, 1, 1, 1, 2, 2, 2, 3, 3, 3, 4, 4, 4)  # indexed by month number
+
+# Tesla Q2 2025 reference figures for validate_tesla_q2_2025
+TESLA_Q2_2025_REVENUE = Decimal('22500000000')
+TESLA_Q2_2025_REVENUE_TOLERANCE = TESLA_Q2_2025_REVENUE * Decimal('0.001')
+TESLA_Q2_2025_EPS = Decimal('0.3709')  # Updated based on actual Q2 2025 data
+TESLA_Q2_2025_EPS_TOLERANCE = Decimal('0.01')
+
+
+@lru_cache(maxsize=4096)
+def _strptime_first(value: str, formats: Tuple[str, ...]) -> Optional[datetime]:
+    """Parse value with the first matching format; cached because statements repeat the same dates."""
+    for fmt in formats:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _parse_date_column(values: pd.Series, formats: Tuple[str, ...]) -> pd.Series:
+    """Column-wise _strptime_first: each format is tried over the whole column and the first match wins."""
+    parsed = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    for fmt in formats:
+        parsed = parsed.fillna(pd.to_datetime(values, format=fmt, errors='coerce'))
+    return parsed
+
+
+# Characters deleted from numeric strings; str.translate does this in one pass without a regex
+_NUMBER_NOISE = str.maketrans('', '', ',$%\xa0' + string.whitespace)
+_MISSING_STRINGS = frozenset(('', 'N/A', 'n/a', 'NA', '-', 'null', 'None'))
+
+
+@lru_cache(maxsize=4096)
+def _decimal_from_str(value: str) -> Optional[Decimal]:
+    """Strip currency formatting and parse; placeholder strings mean missing. Cached as payloads repeat cells."""
+    cleaned = value.translate(_NUMBER_NOISE)
+    return None if cleaned in _MISSING_STRINGS else Decimal(cleaned)
+
+
+def _decimal_from_float(value: float) -> Optional[Decimal]:
+    """Convert via the shortest repr so 0.4 stays Decimal('0.4'); NaN and infinities mean missing."""
+    return Decimal(repr(value)) if math.isfinite(value) else None
+
+
+def _decimal_from_other(value: Any) -> Optional[Decimal]:
+    """Fallback for numpy scalars and other numeric types."""
+    return None if pd.isna(value) else Decimal(str(value))
+
+
+# Converters keyed by exact type, so the common JSON types skip the generic checks
+_DECIMAL_CONVERTERS = {
+    type(None): lambda value: None,
+    str: _decimal_from_str,
+    int: Decimal,
+    float: _decimal_from_float,
+    Decimal: lambda value: value,
+}
+
+
+def _is_missing(value: Any) -> bool:
+    """Scalar None/NaN/NaT check for per-record code; cheaper than pd.isna's generic dispatch."""
+    return value is None or value is pd.NaT or (isinstance(value, float) and value != value)
+
 
 class ValidationError(Exception):
     """Raised when data validation fails."""
@@ -30,34 +98,40 @@ class DataTransformer:
         
     def standardize_quarter_date(self, date_str: Union[str, datetime, date]) -> str:
         """Standardize quarter date to "YYYY-QN" format."""
-        if pd.isna(date_str) or date_str is None:
+        if _is_missing(date_str):
             return None
             
         try:
             if isinstance(date_str, str):
-                for fmt in ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%m/%d/%Y', '%d/%m/%Y']:
-                    try:
-                        dt = datetime.strptime(date_str, fmt)
-                        break
-                    except ValueError:
-                        continue
-                else:
+                dt = _strptime_first(date_str, QUARTER_DATE_FORMATS)
+                if dt is None:
                     raise ValueError(f"Unknown date format: {date_str}")
-            elif isinstance(date_str, (datetime, date)):
-                dt = date_str if isinstance(date_str, datetime) else datetime.combine(date_str, datetime.min.time())
+            elif isinstance(date_str, date):  # includes datetime
+                dt = date_str
             else:
                 raise ValueError(f"Unsupported date type: {type(date_str)}")
             
-            month = dt.month
-            quarter = 1 if month <= 3 else 2 if month <= 6 else 3 if month <= 9 else 4
-            return f"{dt.year}-Q{quarter}"
+            return self._quarter_label(dt)
             
         except Exception as e:
             logger.warning(f"Failed to standardize date {date_str}: {e}")
             return None
     
-    def extract_core_metrics(self, raw_data: Dict, ticker: str, source: str = 'fmp') -> List[FinancialData]:
+    def _quarter_label(self, value: date) -> str:
+        """Label an already-parsed date or datetime as "YYYY-QN"."""
+        return f"{value.year}-Q{MONTH_QUARTERS[value.month]}"
+    
+    def standardize_quarter_dates(self, values: Iterable[Any]) -> List[Optional[str]]:
+        """Vectorized standardize_quarter_date: parse each format over all values at once; unparseable ones give None."""
+        dates = _parse_date_column(pd.Series(list(values), dtype=object), QUARTER_DATE_FORMATS)
+        labels = dates.dt.year.astype('Int64').astype(str) + '-Q' + dates.dt.quarter.astype('Int64').astype(str)
+        return labels.where(dates.notna(), None).tolist()
+    
+    def extract_core_metrics(self, raw_data: Union[Dict, Iterable[Dict], pd.DataFrame], ticker: str,
+                             source: str = 'fmp') -> List[FinancialData]:
         """Extract core financial metrics from raw API data."""
+        if isinstance(raw_data, pd.DataFrame):
+            return self.extract_core_metrics_df(raw_data, ticker)
         if not raw_data:
             logger.warning(f"No data to process for {ticker}")
             return []
@@ -65,21 +139,22 @@ class DataTransformer:
         financial_records = []
         
         try:
+            # Any iterable of records is consumed lazily, so callers can stream rows in
+            records = [raw_data] if isinstance(raw_data, dict) else raw_data
+            
             if source == 'fmp':
-                records = raw_data if isinstance(raw_data, list) else [raw_data]
-                
                 for record in records:
                     try:
                         raw_date = record.get('date') or record.get('calendarYear')
                         quarter_date = self._parse_date(raw_date)
-                        quarter_label = self.standardize_quarter_date(quarter_date)
+                        quarter_label = self._quarter_label(quarter_date) if quarter_date else None
                         
                         if not quarter_label:
                             logger.warning(f"Skipping record with invalid date: {raw_date}")
                             continue
                         
                         revenue = self._safe_decimal_convert(record.get('revenue'))
-                        eps = self._safe_decimal_convert(record.get('eps') or record.get('netIncomePerShare'))
+                        eps = self._safe_decimal_convert(record.get('eps') or record.get('netIncomePerShare'), in_millions=False)
                         gross_profit = self._safe_decimal_convert(record.get('grossProfit'))
                         
                         # Create validated financial data
@@ -93,20 +168,18 @@ class DataTransformer:
                         )
                         
                         financial_records.append(financial_data)
-                        logger.debug(f"Processed {ticker} {quarter_label}: revenue={revenue}, eps={eps}")
+                        logger.debug("Processed %s %s: revenue=%s, eps=%s", ticker, quarter_label, revenue, eps)
                         
                     except Exception as e:
                         logger.warning(f"Failed to process record for {ticker}: {e}")
                         continue
                         
             elif source == 'yfinance':
-                records = raw_data if isinstance(raw_data, list) else [raw_data]
-                
                 for record in records:
                     try:
                         raw_date = record.get('date')
                         quarter_date = self._parse_date(raw_date)
-                        quarter_label = self.standardize_quarter_date(quarter_date)
+                        quarter_label = self._quarter_label(quarter_date) if quarter_date else None
                         
                         if not quarter_label:
                             continue
@@ -138,19 +211,66 @@ class DataTransformer:
             logger.error(f"Failed to extract metrics for {ticker}: {e}")
             return []
     
+    def extract_core_metrics_df(self, df: pd.DataFrame, ticker: str) -> List[FinancialData]:
+        """Extract core metrics from FMP-shaped records already held in a DataFrame, parsing dates column-wise."""
+        if df.empty:
+            logger.warning(f"No data to process for {ticker}")
+            return []
+        
+        raw_dates = df['date'] if 'date' in df else pd.Series(None, index=df.index, dtype=object)
+        if 'calendarYear' in df:
+            raw_dates = raw_dates.where(raw_dates.notna() & (raw_dates != ''), df['calendarYear'])
+        dates = _parse_date_column(raw_dates, PARSE_DATE_FORMATS)
+        # Bare numbers are fiscal years ending 31 December, as in _parse_date
+        years = pd.to_numeric(raw_dates.where(raw_dates.map(lambda v: isinstance(v, (int, float)))), errors='coerce') // 1
+        dates = dates.fillna(pd.to_datetime(pd.DataFrame({'year': years, 'month': 12, 'day': 31}), errors='coerce'))
+        
+        valid = dates.notna()
+        if not valid.all():
+            logger.warning(f"Skipping {(~valid).sum()} {ticker} records with invalid dates")
+            df, dates = df[valid], dates[valid]
+        
+        eps = df['eps'] if 'eps' in df else pd.Series(None, index=df.index, dtype=object)
+        if 'netIncomePerShare' in df:
+            # Same fallback as the per-record `eps or netIncomePerShare`
+            eps = eps.where(eps.notna() & (eps != '') & (eps != 0), df['netIncomePerShare'])
+        labels = self.standardize_quarter_dates(dates)
+        
+        financial_records = []
+        for quarter_date, quarter_label, revenue, eps_value, gross_profit in zip(
+            dates.dt.date, labels, self._decimal_column(df.get('revenue')),
+            self._decimal_column(eps, in_millions=False), self._decimal_column(df.get('grossProfit'))
+        ):
+            try:
+                financial_records.append(FinancialData(
+                    ticker=ticker, quarter_date=quarter_date, quarter_label=quarter_label,
+                    revenue=revenue, eps=eps_value, gross_profit=gross_profit
+                ))
+            except Exception as e:
+                logger.warning(f"Failed to process record for {ticker}: {e}")
+        
+        logger.info(f"Extracted {len(financial_records)} records for {ticker} from fmp")
+        return financial_records
+    
+    def _decimal_column(self, values: Optional[pd.Series], in_millions: bool = True) -> Iterable[Optional[Decimal]]:
+        """Column-wise _safe_decimal_convert; each value becomes a Decimal before scaling so floats keep their digits."""
+        if values is None:
+            return itertools.repeat(None)
+        return [self._safe_decimal_convert(value, in_millions) for value in values.tolist()]
+    
     def _parse_date(self, date_value: Any) -> Optional[date]:
         """Parse date from various formats to date object."""
-        if pd.isna(date_value) or date_value is None:
+        if _is_missing(date_value):
             return None
             
         try:
             if isinstance(date_value, str):
-                for fmt in ['%Y-%m-%d', '%Y-%m-%d %H:%M:%S', '%m/%d/%Y']:
-                    try:
-                        return datetime.strptime(date_value, fmt).date()
-                    except ValueError:
-                        continue
-                raise ValueError(f"Unknown date format: {date_value}")
+                if len(date_value) == 10 and date_value[4] == date_value[7] == '-':
+                    return date.fromisoformat(date_value)  # plain YYYY-MM-DD, as FMP sends; skips strptime
+                dt = _strptime_first(date_value, PARSE_DATE_FORMATS)
+                if dt is None:
+                    raise ValueError(f"Unknown date format: {date_value}")
+                return dt.date()
             elif isinstance(date_value, datetime):
                 return date_value.date()
             elif isinstance(date_value, date):
@@ -165,25 +285,19 @@ class DataTransformer:
             logger.warning(f"Failed to parse date {date_value}: {e}")
             return None
     
-    def _safe_decimal_convert(self, value: Any) -> Optional[Decimal]:
-        """Safely convert value to Decimal, handling None and invalid values."""
-        if pd.isna(value) or value is None or value == '':
-            return None
-            
+    def _safe_decimal_convert(self, value: Any, in_millions: bool = True) -> Optional[Decimal]:
+        """Safely convert value to Decimal; amounts under 1M are read as millions unless in_millions is False (EPS)."""
         try:
-            if isinstance(value, str):
-                cleaned = re.sub(r'[,$%\s]', '', value)
-                if not cleaned or cleaned in ['N/A', 'n/a', '-']:
-                    return None
-                value = cleaned
-            
-            decimal_value = Decimal(str(value))
-            if 0 < decimal_value < 1_000_000:
-                decimal_value = decimal_value * 1_000_000
-            return decimal_value
+            decimal_value = _DECIMAL_CONVERTERS.get(type(value), _decimal_from_other)(value)
         except (InvalidOperation, ValueError, TypeError) as e:
-            logger.debug(f"Failed to convert {value} to Decimal: {e}")
+            logger.debug("Failed to convert %r to Decimal: %s", value, e)
             return None
+        
+        if decimal_value is None or not decimal_value.is_finite():
+            return None
+        if in_millions and 0 < decimal_value < 1_000_000:
+            decimal_value = decimal_value * 1_000_000
+        return decimal_value
     
     def _estimate_eps(self, net_income: Decimal, ticker: str) -> Optional[Decimal]:
         """Estimate EPS from net income using approximate share counts."""
@@ -205,7 +319,7 @@ class DataTransformer:
         all_financial_data = []
         
         for ticker, result in extraction_results.items():
-            if result['status'] not in ['success', 'partial']:
+            if result['status'] not in USABLE_STATUSES:
                 logger.warning(f"Skipping {ticker} - extraction failed: {result.get('errors', [])}")
                 continue
             
@@ -231,32 +345,22 @@ class DataTransformer:
     
     def validate_tesla_q2_2025(self, financial_data: List[FinancialData]) -> bool:
         """Validate Tesla Q2 2025 data against known values: Revenue $22.5B (±0.1%), EPS $0.40 (±0.01)."""
-        tesla_q2_2025 = None
-        
-        for record in financial_data:
-            if record.ticker == 'TSLA' and record.quarter_label == '2025-Q2':
-                tesla_q2_2025 = record
-                break
+        tesla_q2_2025 = next((record for record in financial_data
+                              if record.ticker == 'TSLA' and record.quarter_label == '2025-Q2'), None)
         
         if not tesla_q2_2025:
             logger.warning("Tesla Q2 2025 data not found for validation")
             return False
         
-        expected_revenue = Decimal('22500000000')
-        tolerance_revenue = expected_revenue * Decimal('0.001')
-        
         if tesla_q2_2025.revenue:
-            revenue_diff = abs(tesla_q2_2025.revenue - expected_revenue)
-            if revenue_diff > tolerance_revenue:
-                raise ValidationError(f"Tesla Q2 2025 revenue validation failed: Expected ${expected_revenue:,.0f}, got ${tesla_q2_2025.revenue:,.0f}")
-        
-        expected_eps = Decimal('0.3709')  # Updated based on actual Q2 2025 data
-        tolerance_eps = Decimal('0.01')
+            revenue_diff = abs(tesla_q2_2025.revenue - TESLA_Q2_2025_REVENUE)
+            if revenue_diff > TESLA_Q2_2025_REVENUE_TOLERANCE:
+                raise ValidationError(f"Tesla Q2 2025 revenue validation failed: Expected ${TESLA_Q2_2025_REVENUE:,.0f}, got ${tesla_q2_2025.revenue:,.0f}")
         
         if tesla_q2_2025.eps:
-            eps_diff = abs(tesla_q2_2025.eps - expected_eps)
-            if eps_diff > tolerance_eps:
-                raise ValidationError(f"Tesla Q2 2025 EPS validation failed: Expected ${expected_eps}, got ${tesla_q2_2025.eps}")
+            eps_diff = abs(tesla_q2_2025.eps - TESLA_Q2_2025_EPS)
+            if eps_diff > TESLA_Q2_2025_EPS_TOLERANCE:
+                raise ValidationError(f"Tesla Q2 2025 EPS validation failed: Expected ${TESLA_Q2_2025_EPS}, got ${tesla_q2_2025.eps}")
         
         logger.info("Tesla Q2 2025 validation passed")
         return True
@@ -266,15 +370,21 @@ class DataTransformer:
         if not financial_data:
             return pd.DataFrame()
         
-        records = [{
-            'ticker': data.ticker, 'quarter_date': data.quarter_date, 'quarter_label': data.quarter_label,
-            'revenue': float(data.revenue) if data.revenue else None,
-            'eps': float(data.eps) if data.eps else None,
-            'gross_profit': float(data.gross_profit) if data.gross_profit else None,
-            'processed_at': datetime.now().isoformat()
-        } for data in financial_data]
+        def as_float(values):
+            return [float(value) if value else None for value in values]
+        
+        # One list per column, so pandas takes its columnar constructor path
+        columns = {
+            'ticker': [data.ticker for data in financial_data],
+            'quarter_date': [data.quarter_date for data in financial_data],
+            'quarter_label': [data.quarter_label for data in financial_data],
+            'revenue': as_float(data.revenue for data in financial_data),
+            'eps': as_float(data.eps for data in financial_data),
+            'gross_profit': as_float(data.gross_profit for data in financial_data),
+            'processed_at': datetime.now().isoformat()  # one timestamp for the whole export
+        }
         
-        df = pd.DataFrame(records).sort_values(['ticker', 'quarter_date'], ascending=[True, False])
+        df = pd.DataFrame(columns).sort_values(['ticker', 'quarter_date'], ascending=[True, False])
         logger.info(f"Created DataFrame with {len(df)} records")
         return df
     
@@ -290,6 +400,7 @@ class DataTransformer:
 
 
 if __name__ == "__main__":
+    setup_logging()
     transformer = DataTransformer()
     test_dates = ["2025-06-30", "2025-03-31", "2025-09-30", "2025-12-31"]
     for test_date in test_dates: